@@ -3,6 +3,22 @@ import os, string, time, re, glob
 import seiscomp.kernel, seiscomp.config
 
 class Module(seiscomp.kernel.Module):
+  # defaults for parameters missing in the module configuration
+  defaults = (
+    ("title", "SeedLink Monitor"),
+    ("refresh", "180"),
+    ("address", "127.0.0.1"),
+    ("email", ""),
+    # live seismograms, yet to be implemented correctly
+    ("liveurl", "http://geofon.gfz-potsdam.de/waveform/liveseis.php?station=%s"),
+    # favicon:
+    ("icon", "http://www.gfz-potsdam.de/favicon.ico"),
+    # link name to external site in footer
+    ("linkname", "GEOFON"),
+    # link to external site in footer
+    ("linkurl", "http://www.gfz-potsdam.de/geofon/"),
+  )
+
   def __init__(self, env):
     seiscomp.kernel.Module.__init__(self, env, env.moduleName(__file__))
     self.config_dir = os.path.join(self.env.SEISCOMP_ROOT, "var", "lib", self.name)
@@ -21,41 +37,15 @@ class Module(seiscomp.kernel.Module):
 
     self.params = dict([(x, ",".join(cfg.getStrings(x))) for x in cfg.names()])
 
-    try: self.params['title']
-    except: self.params['title'] = "SeedLink Monitor"
-
-    try: self.params['refresh']
-    except: self.params['refresh'] = "180"
-    
-    try: self.params['address']
-    except: self.params['address'] = "127.0.0.1"
+    for name, value in self.defaults:
+      self.params.setdefault(name, value)
 
     try: int(self.params['port'])
     except: self.params['port'] = 18000
 
-    try: self.params['email']
-    except: self.params['email'] = ""
-
     try: self.params['wwwdir'] = self.params['wwwdir'].replace("@ROOTDIR@", self.env.SEISCOMP_ROOT).replace("@NAME@", self.name)
     except: self.params['wwwdir'] = os.path.join(self.env.SEISCOMP_ROOT, "var", "run", "slmon")
 
-    # yet to be implemente correctly:
-    # live seismograms, lin  in footer:
-    try: self.params['liveurl']
-    except: self.params['liveurl'] = "http://geofon.gfz-potsdam.de/waveform/liveseis.php?station=%s"
-    
-    # favicon:
-    try: self.params['icon']
-    except: self.params['icon'] = "http://www.gfz-potsdam.de/favicon.ico"
-    
-    # link name to external site in footer
-    try: self.params['linkname']
-    except: self.params['linkname'] = "GEOFON"
-    
-    # link to external site in footer
-    try: self.params['linkurl']
-    except: self.params['linkurl'] = "http://www.gfz-potsdam.de/geofon/"
-
     return cfg
 
 
@@ -2,9 +2,10 @@
 
 from __future__ import print_function
 from    getopt  import getopt, GetoptError
-from    time    import time, gmtime
+from    time    import time
 from    datetime import datetime
-import  os, sys, signal, glob, re
+from    bisect  import bisect_left
+import  os, sys, signal, glob, re, subprocess
 from    seiscomp.myconfig import MyConfig
 import  seiscomp.slclient
 import seiscomp.kernel, seiscomp.config
@@ -45,6 +46,8 @@ ini_stations = os.path.join(seiscompRoot,'var/lib/slmon/stations.ini')
 ini_setup = os.path.join(seiscompRoot,'var/lib/slmon/config.ini')
 
 regexStreams = re.compile("[SLBVEH][HNLG][ZNE123]")
+# the channel codes matched by regexStreams, for plain membership tests
+validChannels = frozenset(a+b+c for a in "SLBVEH" for b in "HNLG" for c in "ZNE123")
 
 verbose = 0
 
@@ -55,7 +58,14 @@ class Module(seiscomp.kernel.Module):
   def printCrontab(self):
     print("3 * * * * %s/bin/seiscomp check slmon >/dev/null 2>&1" % (self.env.SEISCOMP_ROOT))
 
-class Status:
+class Status(object):
+
+    # one instance per stream, so avoid the per-instance __dict__
+    __slots__ = ("net", "sta", "loc", "cha", "typ", "last_data", "last_feed")
+
+    def __init__(self):
+        self.net = self.sta = self.loc = self.cha = self.typ = ""
+        self.last_data = self.last_feed = None
 
     def __repr__(self):
         return "%2s %-5s %2s %3s %1s %s %s" % \
@@ -69,42 +79,70 @@ class StatusDict(dict):
 
     def fromSlinkTool(self,server="",stations=["GE_MALT","GE_MORC","GE_IBBN"]):
         # later this shall use XML
-        cmd = "slinktool -nd 10 -nt 10 -Q %s" % server
-        print(cmd)
-        f = os.popen(cmd)
-        # regex = re.compile("[SLBVEH][HNLG][ZNE123]")
-        regex = regexStreams
-        for line in f:
-            net_sta = line[:2].strip() + "_" + line[3:8].strip()
-            if not net_sta in stations:
+        args = ["slinktool", "-nd", "10", "-nt", "10", "-Q", server]
+        print(" ".join(args))
+        # no shell in between and a fully buffered pipe
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=-1,
+                                universal_newlines=True)
+        stations = set(stations)
+        for line in proc.stdout:
+            # cheapest tests first; each fixed-width field is sliced once
+            if line[16:17] != "D":
                 continue
-            typ = line[16]
-            if typ != "D":
+            cha = line[12:15]
+            if cha not in validChannels:
                 continue
-            cha = line[12:15].strip()
-            if not regex.match(cha):
+            net = line[0:2].strip()
+            sta = line[3:8].strip()
+            if not "%s_%s" % (net, sta) in stations:
                 continue
 
             d = Status()
-            d.net = line[ 0: 2].strip()
-            d.sta = line[ 3: 8].strip()
+            d.net = net
+            d.sta = sta
             d.loc = line[ 9:11].strip()
-            d.cha = line[12:15]
-            d.typ = line[16]
+            d.cha = cha
+            d.typ = "D"
             d.last_data = seiscomp.slclient.timeparse(line[47:70])
             d.last_feed = d.last_data
-            sec = "%s_%s" % (d.net, d.sta)
-            sec = "%s.%s.%s.%s.%c" % (d.net, d.sta, d.loc, d.cha, d.typ)
+            sec = "%s.%s.%s.%s.%c" % (net, sta, d.loc, cha, d.typ)
             self[sec] = d
+        proc.stdout.close()
+        proc.wait()
+
+    def merge(self, records):
+        """
+        Updates the streams from a dict mapping stream ids to tuples of
+        (last_data, last_feed), with last_feed given in seconds since the
+        epoch as returned by time.time(). Ids of streams that are not
+        monitored are ignored. The records dict is emptied afterwards.
+        """
+        for id, (last_data, last_feed) in records.items():
+            d = self.get(id)
+            if d is None:
+                continue
+            d.last_data = last_data
+            d.last_feed = datetime.utcfromtimestamp(last_feed)
+        records.clear()
 
     def read(self, source):
-        if type(source) == str:
-            source = file(source)
-        if type(source) == file:
+        if isinstance(source, str):
+            with open(source) as f:
+                source = f.readlines()
+        elif hasattr(source, "readlines"):
             source = source.readlines()
-        if type(source) != list:
+        if not isinstance(source, list):
             raise TypeError('cannot read from %s' % str(type(source)))
 
+        # many streams share the same time stamps, so parse each one once
+        times = {}
+        def timeparse(t):
+            try:
+                return times[t]
+            except KeyError:
+                tim = times[t] = seiscomp.slclient.timeparse(t)
+                return tim
+
         for line in source:
             d = Status()
             d.net = line[ 0: 2]
@@ -112,24 +150,22 @@ class StatusDict(dict):
             d.loc = line[ 9:11].strip()
             d.cha = line[12:15]
             d.typ = line[16]
-            d.last_data = seiscomp.slclient.timeparse(line[18:41])
-            d.last_feed = seiscomp.slclient.timeparse(line[42:65])
+            d.last_data = timeparse(line[18:41])
+            d.last_feed = timeparse(line[42:65])
             if  d.last_feed < d.last_data:
                 d.last_feed = d.last_data
             sec = "%s_%s:%s.%s.%c" % (d.net, d.sta, d.loc, d.cha, d.typ)
             self[sec] = d
 
     def write(self, f):
-        if type(f) is str:
-            f = file(f, "w")
-        lines = []
-        for key in list(self.keys()):
-            lines.append(str(self[key]))
-        lines.sort()
-        f.write('\n'.join(lines)+'\n')
-
-def colorLegend(htmlfile):
-    htmlfile.write("<p><center>Latencies:<br>\n" \
+        if isinstance(f, str):
+            with open(f, "w") as fp:
+                return self.write(fp)
+        # sorted line by line, no joined copy of the whole table
+        f.writelines(sorted("%s\n" % d for d in self.values()))
+
+def colorLegend():
+    return "<p><center>Latencies:<br>\n" \
         "<table cellpadding='2' cellspacing='1' border='0'" \
               " bgcolor='#000000'>\n<tr>\n" \
         "<td bgcolor='#FFFFFF'><b>&le; 1 min&nbsp</b></td>\n" \
@@ -144,7 +180,7 @@ def colorLegend(htmlfile):
         "<td bgcolor='#CCCCCC'><b>&gt; 3 days&nbsp</b></td>\n" \
         "<td bgcolor='#999999'><font color='#FFFFFF'><b>&gt; 4 days&nbsp</b></font></td>\n" \
         "<td bgcolor='#666666'><font color='#FFFFFF'><b>&gt; 5 days&nbsp</b></font></td>\n" \
-        "</tr>\n</table>\n</center></p>\n")
+        "</tr>\n</table>\n</center></p>\n"
 
 # encodes an email address so that it cannot (easily) be extracted
 # from the web page. This is meant to be a spam protection.
@@ -152,36 +188,42 @@ def encode(txt): return ''.join(["&#%d;" % ord(c) for c in txt])
 
 def total_seconds(td): return td.seconds + (td.days*86400)
 
-def pageTrailer(htmlfile, config):
+def pageTrailer(config, now):
 
-    htmlfile.write("<hr>\n" \
+    # the same for all pages of an update cycle, see makeMainHTML
+    setup = config['setup']
+    return ("<hr>\n" \
         "<table width='99%%' cellpaddding='2' cellspacing='1' border='0'>\n" \
-            "<tr>\n<td>Last updated %04d/%02d/%02d %02d:%02d:%02d UTC</td>\n" \
+            "<tr>\n<td>Last updated %s UTC</td>\n" \
             "    <td align='right'><a href='%s' " \
             "target='_top'>%s</a></td>\n</tr>\n" \
-        "</table>\n</body></html>\n" % (gmtime()[:6]  +  (config['setup']['linkurl'],) +  (config['setup']['linkname'],)) )
-
-def getColor(delta):
-    delay = total_seconds(delta)
-    if   delay > 432000: return '#666666'  # > 5 days
-    elif delay > 345600: return '#999999'  # > 4 days
-    elif delay > 259200: return '#CCCCCC'  # > 3 days
-    elif delay > 172800: return '#FFB3B3'  # > 2 days
-    elif delay >  86400: return '#FF3333'  # > 1 day
-    elif delay >  21600: return '#FF9966'  # > 6 hours
-    elif delay >   7200: return '#FFFF00'  # > 2 hours
-    elif delay >   3600: return '#00FF00'  # > 1 hour
-    elif delay >   1800: return '#3399FF'  # > 30 minutes
-    elif delay >    600: return '#9470BB'  # > 10 minutes
-    elif delay >     60: return '#EBD6FF'  # > 1 minute
-    else:                return '#FFFFFF'  # <= 1 minute
+        "</table>\n</body></html>\n" % (now.strftime("%Y/%m/%d %H:%M:%S"), setup['linkurl'], setup['linkname']))
+
+# latency thresholds in seconds and the colors used up to each of them,
+# the last color is used for anything above the last threshold
+latencyThresholds = (60, 600, 1800, 3600, 7200, 21600,
+                     86400, 172800, 259200, 345600, 432000)
+latencyColors = ('#FFFFFF',  # <= 1 minute
+                 '#EBD6FF',  # > 1 minute
+                 '#9470BB',  # > 10 minutes
+                 '#3399FF',  # > 30 minutes
+                 '#00FF00',  # > 1 hour
+                 '#FFFF00',  # > 2 hours
+                 '#FF9966',  # > 6 hours
+                 '#FF3333',  # > 1 day
+                 '#FFB3B3',  # > 2 days
+                 '#CCCCCC',  # > 3 days
+                 '#999999',  # > 4 days
+                 '#666666')  # > 5 days
+
+# latencies are passed around in whole seconds, see total_seconds()
+def getColor(delay):
+    return latencyColors[bisect_left(latencyThresholds, delay)]
 
 TDdummy = "<td align='center' bgcolor='%s'><tt>n/a</tt></td>"
 
-def TDf(delta, col="#ffffff"):
-    if delta is None: return TDdummy % col
-
-    t = total_seconds(delta)
+def TDf(t, col="#ffffff"):
+    if t is None: return TDdummy % col
 
     if   t > 86400: x = "%.1f d" % (t/86400.)
     elif t >  7200: x = "%.1f h" % (t/3600.)
@@ -206,14 +248,48 @@ def myrename(name1, name2):
     except OSError:
         print("failed to rename(%s,%s)" % (name1, name2), file=sys.stderr)
 
+def writePage(temp, dest, page):
+
+    # writes the page to temp with plain os.write calls on the encoded
+    # bytes and renames it to dest, so the page is encoded once and
+    # readers never see a partially written file
+    if not isinstance(page, bytes):
+        page = page.encode("utf-8")
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while page:
+            page = page[os.write(fd, page):]
+    finally:
+        os.close(fd)
+    myrename(temp, dest)
+
+
+def streamIndex():
+
+    # maps "NET_STA" to the sorted labels of the streams of that station,
+    # built once per update cycle instead of scanning all streams for
+    # every station page
+    global status
+
+    index = {}
+    for label in sorted(status.keys()):
+        n, s = label.split(".", 2)[:2]
+        net_sta = "%s_%s" % (n, s)
+        try: index[net_sta].append(label)
+        except KeyError: index[net_sta] = [label]
+    return index
+
 
 def makeMainHTML(config):
 
     global status
 
     now = datetime.utcnow()
+    trailer = pageTrailer(config, now)
+    index = streamIndex()
+    setup = config['setup']
 
-    stations = []
+    stations = set()
 
     streams = [ x for x in list(status.keys()) if regexStreams.search(x) ]
 
@@ -223,16 +299,16 @@ def makeMainHTML(config):
     tmp_du = []
 
     for label in streams:
-        lat1 = now - status[label].last_data # XXX
-        lat2 = now - status[label].last_feed # XXX
-        lat3 = lat1-lat2 # XXX
-        if lat3 == 0.: lat3 = lat2 = None
-
-        if label[-2]=='.' and label[-1] in "DE":
-            label = label[:-2]
-        n,s,x,x = label.split(".")
+        d = status[label]
+        lat1 = now - d.last_data # XXX
+        lat2 = now - d.last_feed # XXX
+        lat1, lat2, lat3 = total_seconds(lat1), total_seconds(lat2), \
+                           total_seconds(lat1-lat2)
+
+        # the Status already holds the parts of the label
+        n, s = d.net, d.sta
         if s in stations: continue # avoid duplicates for different locations
-        stations.append(s)
+        stations.add(s)
 
         net_sta = "%s_%s" % (n,s)
         line = "<tr bgcolor='#ffffff'><td><tt>&nbsp;%s <a " \
@@ -243,13 +319,13 @@ def makeMainHTML(config):
         if config.station[net_sta]['type'][:4] == 'real':
                 tmp_rt.append(line)
         else:   tmp_du.append(line)
-        makeStatHTML(net_sta, config)
+        makeStatHTML(net_sta, config, now, trailer, index.get(net_sta, []))
 
-    try: os.makedirs(config['setup']['wwwdir'])
+    try: os.makedirs(setup['wwwdir'])
     except: pass
 
-    temp = "%s/tmp.html"   % config['setup']['wwwdir']
-    dest = "%s/index.html" % config['setup']['wwwdir']
+    temp = "%s/tmp.html"   % setup['wwwdir']
+    dest = "%s/index.html" % setup['wwwdir']
 
     table_begin = """
     <table cellpaddding='2' cellspacing='1' border='0' bgcolor='#000000'>
@@ -267,8 +343,8 @@ def makeMainHTML(config):
     </table>
     """
 
-    htmlfile = open(temp, "w")
-    htmlfile.write("""<html>
+    html = []
+    html.append("""<html>
     <head>
         <title>%s</title>
         <meta http-equiv='refresh' content='%d'>
@@ -276,49 +352,51 @@ def makeMainHTML(config):
     </head>
     <body bgcolor='#ffffff'>
     <center><font size='+2'>%s</font></center>\n""" % \
-            (   config['setup']['title'], int(config['setup']['refresh']),
-                config['setup']['icon'],      config['setup']['title']))
+            (   setup['title'], int(setup['refresh']),
+                setup['icon'],      setup['title']))
 
 
-    htmlfile.write("<center><table cellpaddding='5' cellspacing='5'><tr>\n")
+    html.append("<center><table cellpaddding='5' cellspacing='5'><tr>\n")
     if len(tmp_rt):
-        htmlfile.write("<td valign='top' align='center'>\n" \
-                       "<font size='+1'>Real-time stations<font>\n</td>\n")
+        html.append("<td valign='top' align='center'>\n" \
+                    "<font size='+1'>Real-time stations<font>\n</td>\n")
     if len(tmp_du):
-        htmlfile.write("<td valign='top' align='center'>\n" \
-                       "<font size='+1'>Dial-up stations<font>\n</td>\n")
-    htmlfile.write("</tr><tr>")
+        html.append("<td valign='top' align='center'>\n" \
+                    "<font size='+1'>Dial-up stations<font>\n</td>\n")
+    html.append("</tr><tr>")
     if len(tmp_rt):
-        htmlfile.write("<td valign='top' align='center'>\n")
-        htmlfile.write(table_begin)
-        htmlfile.write("\n".join(tmp_rt))
-        htmlfile.write(table_end)
-        htmlfile.write("</td>\n")
+        html.append("<td valign='top' align='center'>\n")
+        html.append(table_begin)
+        html.append("\n".join(tmp_rt))
+        html.append(table_end)
+        html.append("</td>\n")
     if len(tmp_du):
-        htmlfile.write("<td valign='top' align='center'>\n")
-        htmlfile.write(table_begin)
-        htmlfile.write("\n".join(tmp_du))
-        htmlfile.write(table_end)
-        htmlfile.write("</td>\n")
-    htmlfile.write("</tr></table></center>\n")
-
-    colorLegend(htmlfile)
-    pageTrailer(htmlfile, config)
-    htmlfile.close()
-    myrename(temp, dest)
+        html.append("<td valign='top' align='center'>\n")
+        html.append(table_begin)
+        html.append("\n".join(tmp_du))
+        html.append(table_end)
+        html.append("</td>\n")
+    html.append("</tr></table></center>\n")
+
+    html.append(colorLegend())
+    html.append(trailer)
+    writePage(temp, dest, "".join(html))
 
 
-def makeStatHTML(net_sta, config):
+def makeStatHTML(net_sta, config, now=None, trailer=None, streams=None):
     global status
 
-    try: os.makedirs(config['setup']['wwwdir'])
+    setup = config['setup']
+    station = config.station[net_sta]
+
+    try: os.makedirs(setup['wwwdir'])
     except: pass
 
-    temp = "%s/tmp2.html"  % config['setup']['wwwdir']
-    dest = "%s/%s.html"  % ( config['setup']['wwwdir'], net_sta)
+    temp = "%s/tmp2.html"  % setup['wwwdir']
+    dest = "%s/%s.html"  % ( setup['wwwdir'], net_sta)
 
-    htmlfile = open(temp, "w")
-    htmlfile.write("""<html>
+    html = []
+    html.append("""<html>
         <head>
             <title>%s - Station %s</title>
             <meta http-equiv='refresh' content='%d'>
@@ -326,20 +404,20 @@ def makeStatHTML(net_sta, config):
         </head>
         <body bgcolor='#ffffff'>
             <center><font size='+2'>%s - Station %s</font>\n""" % \
-            (   config['setup']['title'], net_sta, int(config['setup']['refresh']),
-                config['setup']['icon'],
-                config['setup']['title'], net_sta.split("_")[-1]))
+            (   setup['title'], net_sta, int(setup['refresh']),
+                setup['icon'],
+                setup['title'], net_sta.split("_")[-1]))
 
     try:
-        name = config.station[net_sta]['info']
-        htmlfile.write("<br><font size='+1'>%s</font>" % name)
+        name = station['info']
+        html.append("<br><font size='+1'>%s</font>" % name)
     except: pass
-    htmlfile.write("</center>\n")
+    html.append("</center>\n")
 
-    if 'text' in config.station[net_sta]:
-        htmlfile.write("<P>%s</P>\n" % config.station[net_sta]['text'])
+    if 'text' in station:
+        html.append("<P>%s</P>\n" % station['text'])
 
-    htmlfile.write("""<p><center>
+    html.append("""<p><center>
     <table cellpadding='2' cellspacing='1' border='0' bgcolor='#000000'>
     <tr>
       <th bgcolor='#ffffff' align='center' rowspan='2'>Station/<br>Channel</th>
@@ -354,42 +432,46 @@ def makeStatHTML(net_sta, config):
       <th bgcolor='#ffffff' align='center'>Latency</th>
     </tr>""")
 
-    now = datetime.utcnow()
+    # use the time, trailer and streams of the current update cycle if
+    # called from makeMainHTML
+    if now is None:
+        now = datetime.utcnow()
+    if trailer is None:
+        trailer = pageTrailer(config, now)
+    if streams is None:
+        streams = streamIndex().get(net_sta, [])
 
-    netsta2=net_sta.replace("_",".")
-    streams = [ x for x in list(status.keys()) if x.find(netsta2)==0 ]
-    streams.sort()
     for label in streams:
-        tim1 = status[label].last_data
-        tim2 = status[label].last_feed
+        d = status[label]
+        tim1 = d.last_data
+        tim2 = d.last_feed
 
-        lat1, lat2, lat3 = now-tim1, now-tim2, tim2-tim1
+        lat1, lat2, lat3 = total_seconds(now-tim1), total_seconds(now-tim2), \
+                           total_seconds(tim2-tim1)
         col1, col2, col3 = getColor(lat1), getColor(lat2), getColor(lat3)
-        if lat1==lat2: lat2 = lat3 = None
-        if label[-2]=='.' and label[-1] in "DE":
-            label = label[:-2]
-        n,s,loc,c = label.split(".")
-        c = ("%s.%s" % (loc,c)).strip(".")
-        htmlfile.write("<tr bgcolor='#ffffff'><td>" \
-                       "<tt>&nbsp;%s %s&nbsp;</td>%s%s%s%s%s</tr>\n" \
+        if tim1==tim2: lat2 = lat3 = None
+        s = d.sta
+        if d.loc: c = "%s.%s" % (d.loc, d.cha)
+        else:     c = d.cha
+        html.append("<tr bgcolor='#ffffff'><td>" \
+                    "<tt>&nbsp;%s %s&nbsp;</td>%s%s%s%s%s</tr>\n" \
             % (s, c, TDt(tim1, col1), TDf(lat1, col1),
                      TDt(tim2, col2), TDf(lat2, col2),
                      TDf(lat3, col3)))
 
-    htmlfile.write("</table></p>\n")
-    colorLegend(htmlfile)
+    html.append("</table></p>\n")
+    html.append(colorLegend())
 
-    htmlfile.write("<p>\nHow to <a href='http://geofon.gfz-potsdam.de/waveform/status/latency.php' target='_blank'>interpret</a> " \
-                   "these numbers?<br>\n")
-    if 'liveurl' in config['setup']:
+    html.append("<p>\nHow to <a href='http://geofon.gfz-potsdam.de/waveform/status/latency.php' target='_blank'>interpret</a> " \
+                "these numbers?<br>\n")
+    if 'liveurl' in setup:
         # substitute '%s' in live_url by station name
-        url = config['setup']['liveurl'] % s
-        htmlfile.write("View a <a href='%s' target='_blank'>live seismogram</a> of "
-                       "station %s</center>\n" % (url, s))
-    htmlfile.write("</p>\n")
-    pageTrailer(htmlfile, config)
-    htmlfile.close()
-    myrename(temp, dest)
+        url = setup['liveurl'] % s
+        html.append("View a <a href='%s' target='_blank'>live seismogram</a> of "
+                    "station %s</center>\n" % (url, s))
+    html.append("</p>\n")
+    html.append(trailer)
+    writePage(temp, dest, "".join(html))
 
 def read_ini():
     global config, ini_setup, ini_stations
@@ -468,19 +550,21 @@ status.fromSlinkTool(server, stations=net_sta)
 if verbose: status.write(sys.stderr)
 
 nextTimeGenerateHTML = time()
+refreshInterval = int(config['setup']['refresh'])
 
 print("setting up connection to SeedLink server '%s'" % server)
 
+# latest (end time, receive time) per stream id received since the last
+# update of the web pages, merged into status before they are written
+pending = {}
+
 input = seiscomp.slclient.Input(server, streams)
 for rec in input:
-    id = '.'.join([rec.net, rec.sta, rec.loc, rec.cha, rec.rectype])
-#   if not id in status: continue # XXX XXX XXX
-    try:
-        status[id].last_data = rec.end_time
-        status[id].last_feed = datetime.utcnow()
-    except:
-        continue
+    now = time()
+    pending["%s.%s.%s.%s.%s" % (rec.net, rec.sta, rec.loc, rec.cha, rec.rectype)] = \
+        (rec.end_time, now)
 
-    if time() > nextTimeGenerateHTML:
+    if now > nextTimeGenerateHTML:
+        status.merge(pending)
         makeMainHTML(config)
-        nextTimeGenerateHTML = time() + int(config['setup']['refresh'])
+        nextTimeGenerateHTML = time() + refreshInterval